@@ -3,7 +3,7 @@ import tempfile
 from threading import Thread
 
 from compile_lang import CompilerWorker, C_Compiler, Rust_Compiler, \
-  CPP_Compiler, CompilerException
+  CPP_Compiler, CompilerException, CompilerProducer
 import pb_compiler_pb2
 
 
@@ -17,27 +17,86 @@ class RemoteCompiler():
     will block waiting for compiler requests from the Compiler worker. The other
     thread will run the CompilerWorker object which will wait for requests from
     the remote producer.
+
+    The compiler version is probed from the toolchain unless compiler_version
+    is given, so callers starting many workers can probe once with
+    probe_version and share the result.
+
+    The worker registers with the producer on construction. Call stop to
+    deregister; run_compiler answers every request the producer dispatched
+    before acking, then closes the worker and returns. Call abort to have
+    run_compiler return after the current request and fail the rest. If
+    run_compiler is no longer running, call close to fail the outstanding
+    requests and close the worker.
     """
+    STOP = object()
     CompilerEnumToType = {
         pb_compiler_pb2.RegisterCompilerService.C: C_Compiler,
         pb_compiler_pb2.RegisterCompilerService.CPP: CPP_Compiler,
         pb_compiler_pb2.RegisterCompilerService.RUST: Rust_Compiler
     }
 
-    def __init__(self, lang, compiler_version='noversion', procarch='noarch',
-                 addr='localhost'):
+    def __init__(self, lang, compiler_version=None, procarch='noarch',
+                 addr='localhost', context=None):
         self.lang = lang
-        compiler = RemoteCompiler.CompilerEnumToType[self.lang](code='', tempdir='/tmp')
-        self.worker = CompilerWorker(lang, compiler_version=compiler.get_version(), procarch=procarch, addr=addr)
+        if compiler_version is None:
+            compiler_version = RemoteCompiler.probe_version(lang)
+        self.worker = CompilerWorker(lang, compiler_version=compiler_version, procarch=procarch,
+                                     addr=addr, context=context)
+        self.busy = False
+        self.stop_requested = False
+        self.abort_requested = False
+        self.closed = False
+        self.worker.connect()
         self.worker_thread = Thread(target=self.worker)
         self.worker_thread.start()
 
+    @staticmethod
+    def probe_version(lang):
+        compiler = RemoteCompiler.CompilerEnumToType[lang](code='', tempdir='/tmp')
+        return compiler.get_version()
+
+    def stop(self):
+        self.stop_requested = True
+        # Wakes run_compiler if it is waiting for a request
+        self.worker.codeq.put(RemoteCompiler.STOP)
+
+    def abort(self):
+        self.abort_requested = True
+        self.worker.codeq.put(RemoteCompiler.STOP)
+
+    def close(self, finished=False):
+        """Close the worker, failing its outstanding requests unless finished"""
+        if self.closed:
+            return
+        if not finished:
+            self.worker.deregister(CompilerProducer.ABORT)
+        self.worker.close()
+        self.worker_thread.join()
+        self.closed = True
+
+    def idle(self):
+        return not self.busy and self.worker.codeq.empty()
+
     def run_compiler(self):
-        self.worker.connect()
+        deregistered = False
         while True:
+            if self.abort_requested:
+                self.close()
+                return
+            if self.stop_requested and not deregistered:
+                self.worker.deregister()
+                deregistered = True
             logging.info('waiting for request')
             comp_req = pb_compiler_pb2.CompileRequest()
             msg = self.worker.get_compile_req()
+            if msg is RemoteCompiler.STOP:
+                continue
+            if msg is None:
+                # None follows the last request once the producer acked
+                self.close(finished=self.worker.drained)
+                return
+            self.busy = True
             comp_req.MergeFromString(msg)
             tempdir = tempfile.mkdtemp()
             compiler = RemoteCompiler.CompilerEnumToType[self.lang](code=comp_req.code, tempdir=tempdir)
@@ -49,6 +108,7 @@ class RemoteCompiler():
             except CompilerException as e:
                 logging.info('Compilation failed')
             self.worker.send_response(comp_res.SerializeToString())
+            self.busy = False
 
     def log(self, *args, **kwargs):
         print('{}: '.format(pb_compiler_pb2.RegisterCompilerService.Language.Name(self.lang)) + ''.format(args, kwargs))
@@ -1,17 +1,18 @@
 #! /usr/bin/env python3
 
 import hashlib
+import itertools
 import logging
 import os
 import queue
 import subprocess
 from subprocess import CalledProcessError
 import tempfile
+import threading
 import time
 import zmq
 
 import pb_compiler_pb2
-from test import compile_lang_test
 from compile_lang_enums import SUPPORTED_LANGUAGES
 
 
@@ -97,6 +98,62 @@ class Rust_Compiler(C_Compiler):
         super().__init__(*args, **kwargs)
 
 
+class SendQueue():
+    """
+    Hands outgoing frames to the thread that owns a socket
+
+    ZMQ sockets are not thread safe, so only the owning thread may send. put
+    may be called from any thread. It queues the frames and wakes the owner
+    through an inproc PAIR socket, which the owner polls alongside its own
+    socket and answers by calling flush.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, context, socket):
+        self.socket = socket
+        self.q = queue.Queue()
+        self.lock = threading.Lock()
+        endpoint = 'inproc://send-queue-{}'.format(next(SendQueue._ids))
+        self.waker = context.socket(zmq.PAIR)
+        self.waker.bind(endpoint)
+        self.wake_socket = context.socket(zmq.PAIR)
+        self.wake_socket.connect(endpoint)
+        self.closed = False
+
+    def put(self, frames):
+        self.q.put(frames)
+        self.wake()
+
+    def wake(self):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.wake_socket.send(b'', zmq.NOBLOCK)
+            except zmq.Again:
+                # The owner already has wakeups pending
+                pass
+
+    def flush(self):
+        """Send everything queued. Call only from the owning thread."""
+        while True:
+            try:
+                self.waker.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        while True:
+            try:
+                self.socket.send_multipart(self.q.get_nowait())
+            except queue.Empty:
+                return
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wake_socket.close(linger=0)
+        self.waker.close(linger=0)
+
+
 class CompilerProducer():
     """
     Producer object for compile jobs
@@ -109,8 +166,23 @@ class CompilerProducer():
 
     Workers perform compile jobs atomically. So a result from a given worker is
     guaranteed to be that of the least-recently dispatched job.
+
+    Control messages are multipart, unlike requests and results:
+    [DEREGISTER, DRAIN] stops dispatch to a worker and is acked with
+    [DEREGISTER, b'']. Every job dispatched before the ack reaches the worker
+    first, and is still answered. [DEREGISTER, ABORT] is sent for a worker
+    that cannot answer, and fails its outstanding jobs.
+    [QUEUE_DEPTH, <language name>] is answered with
+    [QUEUE_DEPTH, <language name>, <pending job count>].
+
+    Only the thread calling listen uses the socket. dispatch_req queues
+    requests on a SendQueue and listen sends them.
     """
     PORT = 9002
+    DEREGISTER = b'DEREGISTER'
+    DRAIN = b'DRAIN'
+    ABORT = b'ABORT'
+    QUEUE_DEPTH = b'QUEUE_DEPTH'
 
     def __init__(self, addr='127.0.0.1'):
         self.context = zmq.Context()
@@ -120,16 +192,36 @@ class CompilerProducer():
         self.worker_lists = []
         self.result_q = queue.Queue()
         self.worker_q_set = {}
+        self.draining = set()
+        self.send_q = SendQueue(self.context, self.socket)
+        self.lock = threading.Lock()
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        self.poller.register(self.send_q.waker, zmq.POLLIN)
 
     def listen(self):
-        address, message = self.socket.recv_multipart()
-        for worker_list_name in self.worker_lists:
-            if address in getattr(self, worker_list_name):
-                resp_msg = pb_compiler_pb2.CompileResult()
-                print('res msg recv\'d {} address {}'.format(message, address))
-                ret = resp_msg.MergeFromString(message)
+        events = dict(self.poller.poll())
+        if self.socket in events:
+            self._recv()
+        if self.send_q.waker in events:
+            self.send_q.flush()
+
+    def _recv(self):
+        address, *frames = self.socket.recv_multipart()
+        if len(frames) > 1:
+            self._control(address, frames)
+            return
+        message = frames[0]
+        if address in self.worker_q_set:
+            resp_msg = pb_compiler_pb2.CompileResult()
+            print('res msg recv\'d {} address {}'.format(message, address))
+            ret = resp_msg.MergeFromString(message)
+            with self.lock:
                 self._put_compile_result((self.worker_q_set[address].pop(0), resp_msg.success))
-                return
+                if address in self.draining and not self.worker_q_set[address]:
+                    self.draining.remove(address)
+                    del self.worker_q_set[address]
+            return
         reg_msg = pb_compiler_pb2.RegisterCompilerService()
         print('reg msg recv\'d {} address {}'.format(message, address))
         ret = reg_msg.MergeFromString(message)
@@ -145,6 +237,8 @@ class CompilerProducer():
         enough.
 
         Returns -1 if no worker of the desired type is available
+
+        Requests go to the worker with the fewest outstanding jobs
         """
         worker_list = []
         try:
@@ -156,11 +250,34 @@ class CompilerProducer():
         req = pb_compiler_pb2.CompileRequest()
         req.code = code
         msg = req.SerializeToString()
-        self.socket.send_multipart([worker_list[0], msg])
-        m = hashlib.md5(worker_list[0] + msg).hexdigest()
-        self.worker_q_set[worker_list[0]].append(m)
+        with self.lock:
+            if not worker_list:
+                print('no {} workers registered'.format(language.name))
+                return -1
+            address = min(worker_list, key=lambda a: len(self.worker_q_set[a]))
+            m = hashlib.md5(address + msg).hexdigest()
+            self.worker_q_set[address].append(m)
+            self.send_q.put([address, msg])
         return m
 
+    def pending_jobs(self, language):
+        """Return the number of dispatched but unanswered jobs for a language"""
+        return self._pending_jobs(language.name)
+
+    def _pending_jobs(self, lang):
+        worker_list = getattr(self, '{}'.format(lang) + '_Workers', [])
+        return sum(len(self.worker_q_set.get(address, [])) for address in list(worker_list))
+
+    def _control(self, address, frames):
+        if frames[0] == CompilerProducer.DEREGISTER:
+            self._remove_compiler(address, abort=frames[1] == CompilerProducer.ABORT)
+        elif frames[0] == CompilerProducer.QUEUE_DEPTH:
+            depth = self._pending_jobs(frames[1].decode())
+            self.socket.send_multipart([address, CompilerProducer.QUEUE_DEPTH, frames[1],
+                                        str(depth).encode()])
+        else:
+            print('unknown control msg {} address {}'.format(frames, address))
+
     def _put_compile_result(self, result):
         self.result_q.put(result)
 
@@ -170,15 +287,42 @@ class CompilerProducer():
     def _add_compiler(self, reg_msg, address):
         lang = reg_msg.Language.Name(reg_msg.lang)
         worker_list_name = '{}'.format(lang) + '_Workers'
-        try:
-            getattr(self, worker_list_name).append(address)
-            print('Adding {} worker'.format(lang))
-        except AttributeError as e:
-            print('Adding {} worker list'.format(lang))
-            setattr(self, worker_list_name, [])
-            getattr(self, worker_list_name).append(address)
-            self.worker_lists.append(worker_list_name)
+        with self.lock:
             self.worker_q_set[address] = []
+            try:
+                getattr(self, worker_list_name).append(address)
+                print('Adding {} worker'.format(lang))
+            except AttributeError as e:
+                print('Adding {} worker list'.format(lang))
+                setattr(self, worker_list_name, [address])
+                self.worker_lists.append(worker_list_name)
+
+    def _remove_compiler(self, address, abort=False):
+        """
+        Stop dispatching to a worker that deregistered
+
+        A draining worker is acked and kept until its outstanding jobs are
+        answered. An aborted worker will never answer, so its outstanding jobs
+        are reported as failed compilations.
+        """
+        with self.lock:
+            # Requests queued for this worker must reach it ahead of the ack
+            self.send_q.flush()
+            for worker_list_name in self.worker_lists:
+                worker_list = getattr(self, worker_list_name)
+                if address in worker_list:
+                    print('Removing {} worker'.format(worker_list_name))
+                    worker_list.remove(address)
+            if abort:
+                self.draining.discard(address)
+                for m in self.worker_q_set.pop(address, []):
+                    self._put_compile_result((m, False))
+                return
+            self.socket.send_multipart([address, CompilerProducer.DEREGISTER, b''])
+            if self.worker_q_set.get(address):
+                self.draining.add(address)
+            else:
+                self.worker_q_set.pop(address, None)
 
     def wait_for_worker(self, language):
         worker_list_name = '{}'.format(language.name) + '_Workers'
@@ -200,17 +344,32 @@ class CompilerWorker():
     Handles socket management. Performs initial connection request upon calling
     connect method. Then waits for jobs from producer object in separate thread.
     Received requests are placed on queue for consumption by client.
+
+    Pass context to share one ZMQ context between many workers in a process.
+    Call connect before starting the thread; after that only the thread uses
+    the socket, and send_response and deregister queue frames for it.
+
+    To leave, the client calls deregister. When the producer acks, None is
+    placed on the queue after the last request. The client then calls close,
+    which sends anything still queued, closes the socket and ends the thread.
+    If the thread dies it aborts its registration and places None on the queue.
     """
 
     def __init__(self, lang_type, compiler_version='noversion',
-                 procarch='novalue', addr='localhost'):
-        self.context = zmq.Context()
+                 procarch='novalue', addr='localhost', context=None):
+        self.context = context if context is not None else zmq.Context()
         self.addr = addr
         self.lang_type = lang_type
         self.compiler_version = compiler_version
         self.procarch = procarch
         self.codeq = queue.Queue()
         self.socket = self.context.socket(zmq.DEALER)
+        self.send_q = SendQueue(self.context, self.socket)
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        self.poller.register(self.send_q.waker, zmq.POLLIN)
+        self.running = True
+        self.drained = False
 
     def connect(self):
         self.socket.connect('tcp://{addr}:{port}'.format(addr=self.addr, port=CompilerProducer.PORT))
@@ -221,18 +380,73 @@ class CompilerWorker():
         self.socket.send(reg.SerializeToString())
 
     def wait_for_req(self):
-        message = self.socket.recv()
-        self.codeq.put(message)
+        events = dict(self.poller.poll())
+        if self.socket in events:
+            frames = self.socket.recv_multipart()
+            if len(frames) > 1 and frames[0] == CompilerProducer.DEREGISTER:
+                self.drained = True
+                self.codeq.put(None)
+            else:
+                self.codeq.put(frames[0])
+        if self.send_q.waker in events:
+            self.send_q.flush()
 
     def get_compile_req(self):
         return self.codeq.get()
 
     def send_response(self, bytes_in):
-          self.socket.send(bytes_in)
+          self.send_q.put([bytes_in])
+
+    def deregister(self, mode=CompilerProducer.DRAIN):
+        self.send_q.put([CompilerProducer.DEREGISTER, mode])
+
+    def close(self):
+        self.running = False
+        self.send_q.wake()
 
     def __call__(self):
-        while True:
-            self.wait_for_req()
+        try:
+            while self.running:
+                self.wait_for_req()
+            self.send_q.flush()
+        finally:
+            if self.running and not self.drained:
+                # Crashed, so the client can no longer answer requests
+                try:
+                    self.socket.send_multipart([CompilerProducer.DEREGISTER, CompilerProducer.ABORT],
+                                               zmq.NOBLOCK)
+                except zmq.ZMQError:
+                    pass
+            self.socket.close(linger=1000)
+            self.send_q.close()
+            self.codeq.put(None)
+
+
+class ProducerQueueDepth():
+    """
+    Queries a CompilerProducer for the number of pending jobs of a language
+
+    Returns None if the producer does not answer within the timeout.
+    """
+    TIMEOUT_MS = 1000
+
+    def __init__(self, addr='localhost', context=None):
+        self.context = context if context is not None else zmq.Context()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.connect('tcp://{addr}:{port}'.format(addr=addr, port=CompilerProducer.PORT))
+
+    def __call__(self, lang):
+        name = pb_compiler_pb2.RegisterCompilerService.Language.Name(lang).encode()
+        self.socket.send_multipart([CompilerProducer.QUEUE_DEPTH, name])
+        # Skip replies to earlier queries that timed out
+        while self.socket.poll(ProducerQueueDepth.TIMEOUT_MS):
+            frames = self.socket.recv_multipart()
+            if frames[:2] == [CompilerProducer.QUEUE_DEPTH, name]:
+                return int(frames[2])
+        return None
+
+    def close(self):
+        self.socket.close(linger=0)
 
 def run_compiler(lang, text):
 
@@ -246,6 +460,8 @@ def run_compiler(lang, text):
     return compiler.compile_code()
 
 def main():
+    from test import compile_lang_test
+
     run_compiler(compile_lang_test.SampleCProg.lang, compile_lang_test.SampleCProg.code)
     print('ran C compiler successfully')
     run_compiler(compile_lang_test.SampleCProg2.lang, compile_lang_test.SampleCProg2.code)
@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+
+import argparse
+import logging
+import platform
+import signal
+import threading
+import time
+import zmq
+
+from compile_lang import ProducerQueueDepth
+from RemoteCompilers import RemoteCompiler
+import pb_compiler_pb2
+
+
+class WorkerSupervisor():
+    """
+    Runs a fleet of RemoteCompiler workers from a single process
+
+    Each language gets min_workers slots. The toolchain version is probed once
+    per language and every worker shares one ZMQ context. Slots whose threads
+    have died are replaced on the next poll, and their outstanding jobs are
+    reported as failed.
+
+    If queue_depth is given it is called with each language and should return
+    the number of outstanding jobs for that language, or None if unknown. A
+    ProducerQueueDepth asks a remote producer. The slot count then follows
+    the queue depth between min_workers and max_workers. When scaling down, at
+    most one idle slot per language is retired per poll. The slot deregisters
+    and drains in the background, so jobs already dispatched to it are still
+    answered. A slot that has not drained after DRAIN_TIMEOUT is aborted.
+    """
+    POLL_INTERVAL = 1
+    DRAIN_TIMEOUT = 5
+
+    def __init__(self, langs, min_workers=1, max_workers=None, procarch='noarch',
+                 addr='localhost', queue_depth=None, context=None):
+        if max_workers is None:
+            max_workers = min_workers
+        if max_workers < min_workers:
+            raise ValueError('max_workers {} is less than min_workers {}'.format(max_workers, min_workers))
+        self.langs = langs
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.procarch = procarch
+        self.addr = addr
+        self.queue_depth = queue_depth
+        self.own_context = context is None
+        self.context = zmq.Context() if context is None else context
+        self.versions = {}
+        self.slots = {lang: [] for lang in langs}
+        # (slot, deadline) pairs that are draining
+        self.retiring = []
+        self.stop_event = threading.Event()
+        self.abandon_event = threading.Event()
+
+    def _lang_name(self, lang):
+        return pb_compiler_pb2.RegisterCompilerService.Language.Name(lang)
+
+    def _spawn(self, lang):
+        if lang not in self.versions:
+            self.versions[lang] = RemoteCompiler.probe_version(lang)
+            logging.info('{} version {}'.format(self._lang_name(lang), self.versions[lang]))
+        rc = RemoteCompiler(lang, compiler_version=self.versions[lang], procarch=self.procarch,
+                            addr=self.addr, context=self.context)
+        thread = threading.Thread(target=rc.run_compiler)
+        thread.start()
+        return (rc, thread)
+
+    def _retire(self, slot):
+        slot[0].stop()
+        self.retiring.append((slot, time.monotonic() + WorkerSupervisor.DRAIN_TIMEOUT))
+
+    def _reap(self, abort=False):
+        """Close retiring slots that have finished and abort overdue ones"""
+        retiring = []
+        for slot, deadline in self.retiring:
+            rc, thread = slot
+            if not thread.is_alive():
+                # Closes the worker if run_compiler died instead of finishing
+                rc.close()
+                continue
+            if abort or time.monotonic() > deadline:
+                if not rc.abort_requested:
+                    logging.warning('{} worker did not drain'.format(self._lang_name(rc.lang)))
+                rc.abort()
+            retiring.append((slot, deadline))
+        self.retiring = retiring
+
+    def _restart_crashed(self, lang):
+        slots = self.slots[lang]
+        for i, slot in enumerate(slots):
+            rc, thread = slot
+            if thread.is_alive() and rc.worker_thread.is_alive():
+                continue
+            logging.warning('{} worker died, restarting'.format(self._lang_name(lang)))
+            # Reaped on this poll, or once run_compiler sees the None queued
+            # by the dead receive loop
+            rc.abort()
+            self.retiring.append((slot, time.monotonic()))
+            slots[i] = self._spawn(lang)
+
+    def _target(self, lang):
+        slots = self.slots[lang]
+        depth = len(slots)
+        if self.queue_depth is not None:
+            depth = self.queue_depth(lang)
+            if depth is None:
+                depth = len(slots)
+        return min(max(depth, self.min_workers), self.max_workers)
+
+    def _scale(self, lang):
+        slots = self.slots[lang]
+        target = self._target(lang)
+        if len(slots) < target:
+            logging.info('scaling {} workers {} -> {}'.format(self._lang_name(lang), len(slots), target))
+            while len(slots) < target:
+                slots.append(self._spawn(lang))
+        elif len(slots) > target:
+            idle = [slot for slot in slots if slot[0].idle()]
+            if idle:
+                logging.info('retiring idle {} worker'.format(self._lang_name(lang)))
+                slots.remove(idle[0])
+                self._retire(idle[0])
+
+    def poll(self):
+        for lang in self.langs:
+            self._restart_crashed(lang)
+            self._scale(lang)
+        self._reap()
+
+    def stop(self, drain=True):
+        """
+        Shut the fleet down
+
+        With drain False, workers return after their current request and the
+        rest of their requests are failed.
+        """
+        if not drain:
+            self.abandon_event.set()
+        self.stop_event.set()
+
+    def shutdown(self):
+        for lang in self.langs:
+            for slot in self.slots[lang]:
+                self._retire(slot)
+            self.slots[lang] = []
+        while self.retiring:
+            self._reap(abort=self.abandon_event.is_set())
+            self.abandon_event.wait(0.1)
+        if self.own_context:
+            self.context.term()
+
+    def __call__(self):
+        try:
+            while not self.stop_event.is_set():
+                self.poll()
+                self.stop_event.wait(WorkerSupervisor.POLL_INTERVAL)
+        finally:
+            self.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a fleet of compiler workers')
+    parser.add_argument('--lang', action='append', required=True,
+                        choices=['C', 'CPP', 'RUST'],
+                        help='language to serve, may be repeated')
+    parser.add_argument('-n', '--workers', type=int, default=1,
+                        help='minimum workers per language')
+    parser.add_argument('--max-workers', type=int,
+                        help='maximum workers per language, scaled with producer queue depth')
+    parser.add_argument('--addr', default='localhost', help='producer address')
+    parser.add_argument('--procarch', default=platform.processor())
+    args = parser.parse_args()
+    if args.max_workers is None:
+        args.max_workers = args.workers
+    if args.max_workers < args.workers:
+        parser.error('--max-workers must be at least --workers')
+
+    logging.basicConfig(level=logging.INFO)
+    langs = [pb_compiler_pb2.RegisterCompilerService.Language.Value(name) for name in args.lang]
+    context = zmq.Context()
+    queue_depth = None
+    if args.max_workers > args.workers:
+        queue_depth = ProducerQueueDepth(args.addr, context=context)
+    supervisor = WorkerSupervisor(langs, min_workers=args.workers, max_workers=args.max_workers,
+                                  procarch=args.procarch, addr=args.addr,
+                                  queue_depth=queue_depth, context=context)
+
+    def interrupt(signum, frame):
+        # A second signal aborts the workers instead of draining them
+        supervisor.stop(drain=not supervisor.stop_event.is_set())
+
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        supervisor()
+    finally:
+        if queue_depth is not None:
+            queue_depth.close()
+        context.term()
+
+if __name__ == '__main__':
+    main()
@@ -100,6 +100,7 @@ setup(
     entry_points={
         'console_scripts': [
             'compile_lang=compile_lang:main',
+            'compile_supervisor=compile_supervisor:main',
         ],
     },
 )
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import logging
+import platform
+import time
+
+import compile_lang
+import compile_supervisor
+import pb_compiler_pb2
+from compile_lang_enums import SUPPORTED_LANGUAGES
+from compile_lang_test import SampleCProg
+from threading import Thread
+
+# Producer and supervised worker fleet in one process. The supervisor reads
+# the queue depth over the wire as it would from another host. The fleet grows
+# with the queue depth, spreads new requests across workers, and shrinks again
+# with requests still in flight without failing any of them. Crashed workers
+# are replaced, and a crash does not stop the fleet from shutting down.
+
+MAX_WORKERS = 4
+
+
+def collect(producer, count):
+    results = [producer.get_compile_result() for _ in range(count)]
+    failed = [m for m, success in results if not success]
+    assert not failed, 'failed results {}'.format(failed)
+    print('{} results, all succeeded'.format(count))
+
+
+def wait_for_worker_count(producer, count):
+    while len(producer.C_Workers) != count:
+        time.sleep(0.1)
+
+
+def crash(slot):
+    # A malformed request makes run_compiler raise
+    rc, thread = slot
+    rc.worker.codeq.put(b'\xff')
+    thread.join(10)
+    assert not thread.is_alive(), 'worker did not crash'
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    compile_supervisor.WorkerSupervisor.POLL_INTERVAL = 0.1
+    producer = compile_lang.CompilerProducer()
+    producer_thread = Thread(target=producer, daemon=True)
+    producer_thread.start()
+
+    queue_depth = compile_lang.ProducerQueueDepth()
+    supervisor = compile_supervisor.WorkerSupervisor([pb_compiler_pb2.RegisterCompilerService.C],
+                                                     min_workers=1, max_workers=MAX_WORKERS,
+                                                     procarch=platform.processor(),
+                                                     queue_depth=queue_depth)
+    supervisor_thread = Thread(target=supervisor)
+    supervisor_thread.start()
+    producer.wait_for_worker(SUPPORTED_LANGUAGES.C)
+    wait_for_worker_count(producer, 1)
+
+    print('queueing work on the first worker to trigger scale up')
+    for _ in range(40):
+        producer.dispatch_req(SUPPORTED_LANGUAGES.C, SampleCProg.code)
+    wait_for_worker_count(producer, MAX_WORKERS)
+    print('fleet grown to {}, dispatching across it'.format(MAX_WORKERS))
+    for _ in range(4 * MAX_WORKERS):
+        producer.dispatch_req(SUPPORTED_LANGUAGES.C, SampleCProg.code)
+    loads = sorted(len(producer.worker_q_set[a]) for a in list(producer.C_Workers))
+    print('outstanding jobs per worker {}'.format(loads))
+    assert all(load > 0 for load in loads), 'least loaded dispatch skipped a worker'
+    collect(producer, 40 + 4 * MAX_WORKERS)
+
+    print('dispatching while the fleet scales down')
+    # Slow enough to keep the queue depth near one, so idle slots are retired
+    # while new requests keep landing on them
+    dispatched = 0
+    deadline = time.monotonic() + 30
+    while len(producer.C_Workers) > 1:
+        assert time.monotonic() < deadline, 'fleet did not scale down'
+        producer.dispatch_req(SUPPORTED_LANGUAGES.C, SampleCProg.code)
+        dispatched += 1
+        time.sleep(0.2)
+    collect(producer, dispatched)
+
+    print('crashing a worker')
+    old_workers = set(producer.C_Workers)
+    crash(supervisor.slots[pb_compiler_pb2.RegisterCompilerService.C][0])
+    deadline = time.monotonic() + 30
+    while len(producer.C_Workers) != 1 or set(producer.C_Workers) & old_workers:
+        assert time.monotonic() < deadline, 'crashed worker was not replaced'
+        time.sleep(0.1)
+    for _ in range(4):
+        producer.dispatch_req(SUPPORTED_LANGUAGES.C, SampleCProg.code)
+    collect(producer, 4)
+
+    print('shutting down with jobs in flight')
+    for _ in range(8):
+        producer.dispatch_req(SUPPORTED_LANGUAGES.C, SampleCProg.code)
+    supervisor.stop()
+    supervisor_thread.join()
+    collect(producer, 8)
+    queue_depth.close()
+
+    print('shutting down after a crash the supervisor has not polled yet')
+    compile_supervisor.WorkerSupervisor.POLL_INTERVAL = 60
+    supervisor = compile_supervisor.WorkerSupervisor([pb_compiler_pb2.RegisterCompilerService.C],
+                                                     min_workers=2, procarch=platform.processor())
+    supervisor_thread = Thread(target=supervisor)
+    supervisor_thread.start()
+    wait_for_worker_count(producer, 2)
+    crash(supervisor.slots[pb_compiler_pb2.RegisterCompilerService.C][0])
+    supervisor.stop()
+    supervisor_thread.join(10)
+    assert not supervisor_thread.is_alive(), 'supervisor hung on shutdown'
+    wait_for_worker_count(producer, 0)
+    print('shut down cleanly')